@@ -1,14 +1,23 @@
 # bot.py — Напоминалка с PostgreSQL, подпиской и вебхуком
 
-from aiogram import Bot, Dispatcher, types
+from aiogram import Bot, Dispatcher, F, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.filters import Command
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 import asyncio
 import asyncpg
+import hashlib
 import os
+import traceback
 from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 from aiohttp import web
+from cachetools import TTLCache
 
 # === ЧАСОВОЙ ПОЯС МСК ===
 MOSCOW_TZ = timezone(timedelta(hours=3))
@@ -18,15 +27,98 @@ load_dotenv()
 
 TOKEN = os.getenv("BOT_TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL")
+REDIS_URL = os.getenv("REDIS_URL")  # необязательно: состояния переживут перезапуск
+BASE_URL = os.getenv("WEBHOOK_BASE_URL", "https://telegram-bot-ptrv.onrender.com")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+# Токен в путь не кладём: запросы проверяются по секрету в заголовке
+WEBHOOK_PATH = "/tg/webhook"
+# За pgbouncer в transaction mode LISTEN не работает — тогда ставим 0
+USE_LISTEN = os.getenv("USE_LISTEN", "1") != "0"
+# Там же не живут подготовленные выражения: без LISTEN кэш по умолчанию выключен
+STATEMENT_CACHE_SIZE = int(os.getenv("STATEMENT_CACHE_SIZE", "1024" if USE_LISTEN else "0"))
 
 if not TOKEN:
     raise ValueError("❌ Не установлен BOT_TOKEN")
 if not DATABASE_URL:
     raise ValueError("❌ Не установлен DATABASE_URL")
 
+# Telegram присылает секрет в заголовке X-Telegram-Bot-Api-Secret-Token.
+# Без WEBHOOK_SECRET выводим его из токена — одинаковый во всех процессах.
+# Токен нигде не светится (ни в пути, ни в логах), так что секрет не угадать
+if not WEBHOOK_SECRET:
+    WEBHOOK_SECRET = hashlib.sha256(f"webhook:{TOKEN}".encode()).hexdigest()
+
 # === СОЗДАНИЕ БОТА И ДИСПЕТЧЕРА ===
-bot = Bot(token=TOKEN)
-dp = Dispatcher()
+class TTLMemoryStorage(BaseStorage):
+    # Как MemoryStorage, но незавершённые диалоги живут 10 минут и их
+    # не больше 10000; пустые записи не храним вовсе
+    def __init__(self, maxsize=10_000, ttl=600):
+        self.records = TTLCache(maxsize=maxsize, ttl=ttl)  # {key: (state, data)}
+
+    def _save(self, key, state, data):
+        if state is None and not data:
+            self.records.pop(key, None)
+        else:
+            self.records[key] = (state, data)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        _, data = self.records.get(key, (None, {}))
+        self._save(key, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey):
+        return self.records.get(key, (None, {}))[0]
+
+    async def set_data(self, key: StorageKey, data: dict) -> None:
+        state, _ = self.records.get(key, (None, {}))
+        self._save(key, state, data.copy())
+
+    async def get_data(self, key: StorageKey) -> dict:
+        return self.records.get(key, (None, {}))[1].copy()
+
+    async def close(self) -> None:
+        pass
+
+if REDIS_URL:
+    from aiogram.fsm.storage.redis import RedisStorage
+    # Незавершённые диалоги живут 10 минут
+    storage = RedisStorage.from_url(REDIS_URL, state_ttl=600, data_ttl=600)
+else:
+    storage = TTLMemoryStorage()
+
+# Общая HTTP-сессия: большой пул соединений и долгий keep-alive,
+# чтобы пачки сообщений через asyncio.gather не ждали TLS-рукопожатий
+class KeepAliveSession(AiohttpSession):
+    def __init__(self, **kwargs):
+        super().__init__(limit=100, **kwargs)
+        # Публичного способа передать параметры TCPConnector в aiogram нет:
+        # коннектор собирается лениво из _connector_init (aiogram 3.11, см.
+        # requirements.txt). ttl_dns_cache=3600 из aiogram не трогаем.
+        self._connector_init.update(limit_per_host=50, keepalive_timeout=75)
+
+bot = Bot(token=TOKEN, session=KeepAliveSession())
+dp = Dispatcher(storage=storage)
+
+# Не больше 25 сообщений в секунду (глобальный лимит Telegram ~30/сек):
+# каждый из 25 слотов занят минимум на секунду
+TELEGRAM_RATE = 25
+TELEGRAM_SEMAPHORE = asyncio.Semaphore(TELEGRAM_RATE)
+
+async def send_limited(chat_id, text, attempts=3, **kwargs):
+    loop = asyncio.get_running_loop()
+    for attempt in range(attempts):
+        async with TELEGRAM_SEMAPHORE:
+            started = loop.time()
+            try:
+                return await bot.send_message(chat_id, text, **kwargs)
+            except TelegramRetryAfter as e:
+                if attempt == attempts - 1:
+                    raise
+                retry_after = e.retry_after
+            finally:
+                await asyncio.sleep(max(0.0, 1.0 - (loop.time() - started)))
+        # Telegram сам сказал, сколько ждать
+        print(f"⏳ Флуд-лимит Telegram, жду {retry_after} сек")
+        await asyncio.sleep(retry_after)
 
 # === НАСТРОЙКИ КАНАЛА ===
 CHANNEL_ID = -1003364930972  # Из твоих данных
@@ -39,7 +131,13 @@ async def init_db():
     global db_pool
     print("🔧 Подключаюсь к базе данных...")
     try:
-        db_pool = await asyncpg.create_pool(DATABASE_URL)
+        db_pool = await asyncpg.create_pool(
+            DATABASE_URL,
+            min_size=2,
+            max_size=10,
+            statement_cache_size=STATEMENT_CACHE_SIZE,
+            max_inactive_connection_lifetime=300
+        )
         await db_pool.execute('''
             CREATE TABLE IF NOT EXISTS reminders (
                 id SERIAL PRIMARY KEY,
@@ -49,6 +147,33 @@ async def init_db():
                 repeat TEXT
             )
         ''')
+        # Аренда: до какого момента напоминание занято отправкой
+        await db_pool.execute('''
+            ALTER TABLE reminders ADD COLUMN IF NOT EXISTS claimed_until TIMESTAMPTZ
+        ''')
+        # Индексы: выборка созревших и список пользователя
+        await db_pool.execute('''
+            CREATE INDEX IF NOT EXISTS idx_rem_time ON reminders (remind_time)
+        ''')
+        await db_pool.execute('''
+            CREATE INDEX IF NOT EXISTS idx_rem_user
+                ON reminders (user_id, remind_time)
+        ''')
+        # Триггер: будим фоновую проверку при добавлении напоминания
+        await db_pool.execute('''
+            CREATE OR REPLACE FUNCTION notify_rem() RETURNS trigger AS $$
+            BEGIN
+                PERFORM pg_notify('reminders_new', NEW.remind_time::text);
+                RETURN NEW;
+            END
+            $$ LANGUAGE plpgsql
+        ''')
+        await db_pool.execute('''
+            DROP TRIGGER IF EXISTS reminders_notify ON reminders;
+            CREATE TRIGGER reminders_notify
+                AFTER INSERT ON reminders
+                FOR EACH ROW EXECUTE FUNCTION notify_rem()
+        ''')
         print("✅ База данных готова")
     except Exception as e:
         print(f"❌ Ошибка подключения к БД: {e}")
@@ -75,35 +200,41 @@ async def send_subscription_prompt(message: types.Message):
     )
 
 # === РАБОТА С НАПОМИНАНИЯМИ ===
+def format_time(dt):
+    # "дд.мм чч:мм" по МСК; f-строка быстрее, чем разбор формата в strftime
+    dt = dt.astimezone(MOSCOW_TZ)
+    return f"{dt.day:02d}.{dt.month:02d} {dt.hour:02d}:{dt.minute:02d}"
+
+# Запросы идут через db_pool напрямую: asyncpg кэширует подготовленные
+# выражения на каждом соединении пула
 async def save_reminder(user_id, message, remind_time, repeat):
-    async with db_pool.acquire() as conn:
-        await conn.execute(
-            "INSERT INTO reminders (user_id, message, remind_time, repeat) VALUES ($1, $2, $3, $4)",
-            user_id, message, remind_time, repeat
-        )
+    await db_pool.execute(
+        "INSERT INTO reminders (user_id, message, remind_time, repeat) VALUES ($1, $2, $3, $4)",
+        user_id, message, remind_time, repeat
+    )
 
 async def delete_reminder_by_id(reminder_id):
-    async with db_pool.acquire() as conn:
-        await conn.execute("DELETE FROM reminders WHERE id = $1", reminder_id)
+    await db_pool.execute("DELETE FROM reminders WHERE id = $1", reminder_id)
 
 async def load_user_reminders(user_id):
-    async with db_pool.acquire() as conn:
-        return await conn.fetch("""
-            SELECT id, message, remind_time, repeat 
-            FROM reminders 
-            WHERE user_id = $1 
-            ORDER BY remind_time
-        """, user_id)
+    return await db_pool.fetch("""
+        SELECT id, message, remind_time, repeat 
+        FROM reminders 
+        WHERE user_id = $1 
+        ORDER BY remind_time
+    """, user_id)
 
 # === КНОПКИ ===
+MAIN_KB = ReplyKeyboardMarkup(
+    keyboard=[
+        [KeyboardButton(text="➕ Новое напоминание")],
+        [KeyboardButton(text="📋 Мои напоминания")],
+    ],
+    resize_keyboard=True
+)
+
 def get_main_keyboard():
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="➕ Новое напоминание")],
-            [KeyboardButton(text="📋 Мои напоминания")],
-        ],
-        resize_keyboard=True
-    )
+    return MAIN_KB
 
 REPEAT_TYPES = {
     "daily": "🔁 Ежедневно",
@@ -112,14 +243,50 @@ REPEAT_TYPES = {
     "none": "🚫 Без повтора"
 }
 
-# === ГЛОБАЛЬНОЕ ХРАНЕНИЕ СОСТОЯНИЙ ===
-user_state = {}  # {user_id: {"step": "...", "data": ...}}
+# Шаг повтора в терминах PostgreSQL interval; "none" — без повтора
+REPEAT_INTERVALS = {
+    "daily": "1 day",
+    "weekly": "7 days",
+    "monthly": "1 month"
+}
+
+REPEAT_STEP_SQL = (
+    "CASE repeat "
+    + " ".join(f"WHEN '{k}' THEN interval '{v}'" for k, v in REPEAT_INTERVALS.items())
+    + " END"
+)
+
+# Переносим на первое срабатывание после now(): после простоя бота
+# ежедневное напоминание не должно прийти N раз подряд
+RESCHEDULE_SQL = f"""
+    UPDATE reminders SET claimed_until = NULL, remind_time = (
+        SELECT min(t) FROM generate_series(
+            remind_time + {REPEAT_STEP_SQL},
+            GREATEST(remind_time, now()) + {REPEAT_STEP_SQL},
+            {REPEAT_STEP_SQL}
+        ) AS t
+        WHERE t > now()
+    )
+    WHERE id = ANY($1::int[])
+"""
+
+# Клавиатуры статичны — собираем один раз при импорте
+REPEAT_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text=REPEAT_TYPES[k], callback_data=f"repeat_{k}")]
+    for k in ("none", "daily", "weekly", "monthly")
+])
+
+# === СОСТОЯНИЯ ДИАЛОГА ===
+class Rem(StatesGroup):
+    waiting_message = State()
+    waiting_time = State()
+    waiting_repeat = State()
 
 # === /start ===
 @dp.message(Command("start"))
-async def start(message: types.Message):
+async def start(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
-    user_state[user_id] = None
+    await state.clear()
 
     # Проверяем подписку
     if not await check_subscription(user_id):
@@ -135,12 +302,12 @@ async def start(message: types.Message):
     )
 
 # === КНОПКА: ПРОВЕРКА ПОДПИСКИ ===
-@dp.callback_query(lambda c: c.data == "check_subscription")
-async def process_subscription_check(callback: types.CallbackQuery):
+@dp.callback_query(F.data == "check_subscription")
+async def process_subscription_check(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
 
     if await check_subscription(user_id):
-        user_state[user_id] = None
+        await state.clear()
         await callback.message.edit_text(
             "✅ Отлично! Теперь ты можешь пользоваться ботом.",
             reply_markup=None
@@ -163,98 +330,133 @@ async def process_subscription_check(callback: types.CallbackQuery):
     await callback.answer()
 
 # === НОВОЕ НАПОМИНАНИЕ ===
-@dp.message(lambda m: m.text == "➕ Новое напоминание")
-async def start_remind(message: types.Message):
+@dp.message(F.text == "➕ Новое напоминание")
+async def start_remind(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     if not await check_subscription(user_id):
         await send_subscription_prompt(message)
         return
 
-    user_state[user_id] = {"step": "waiting_message"}
+    await state.set_state(Rem.waiting_message)
     await message.answer("📝 Введи сообщение:")
 
 # === ОБРАБОТКА СООБЩЕНИЯ ===
-@dp.message(lambda m: (user_state.get(m.from_user.id) or {}).get("step") == "waiting_message")
-async def get_message(message: types.Message):
+@dp.message(Rem.waiting_message)
+async def get_message(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     if not await check_subscription(user_id):
         await send_subscription_prompt(message)
         return
 
-    text = message.text.strip()
+    text = (message.text or "").strip()
     if not text:
         await message.answer("❌ Сообщение не может быть пустым.")
         return
-    user_state[user_id] = {"step": "waiting_time", "message": text}
+    await state.update_data(message=text)
+    await state.set_state(Rem.waiting_time)
     await message.answer("⏰ Введи время (чч:мм), например: 15:30\n📌 Время по МСК")
 
 # === ОБРАБОТКА ВРЕМЕНИ ===
-@dp.message(lambda m: (user_state.get(m.from_user.id) or {}).get("step") == "waiting_time")
-async def get_time(message: types.Message):
+@dp.message(Rem.waiting_time)
+async def get_time(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     if not await check_subscription(user_id):
         await send_subscription_prompt(message)
         return
 
-    try:
-        h, m = map(int, message.text.split(":"))
-        now = datetime.now(MOSCOW_TZ)
-        time = now.replace(hour=h, minute=m, second=0, microsecond=0)
-        if time < now:
-            time += timedelta(days=1)
+    # Сначала проверяем ввод; ошибки БД и Telegram уходят в общий обработчик
+    parts = (message.text or "").strip().split(":")
+    if len(parts) != 2 or not parts[0].isdecimal() or not parts[1].isdecimal():
+        await message.answer("❌ Неверный формат. Введи чч:мм (например, 09:00)")
+        return
+    h, m = int(parts[0]), int(parts[1])
+    if not (0 <= h < 24 and 0 <= m < 60):
+        await message.answer("❌ Неверный формат. Введи чч:мм (например, 09:00)")
+        return
 
-        user_state[user_id]["step"] = "waiting_repeat"
-        user_state[user_id]["remind_time"] = time
+    now = datetime.now(MOSCOW_TZ)
+    time = now.replace(hour=h, minute=m, second=0, microsecond=0)
+    if time < now:
+        time += timedelta(days=1)
 
-        kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text=REPEAT_TYPES["none"], callback_data="repeat_none")],
-            [InlineKeyboardButton(text=REPEAT_TYPES["daily"], callback_data="repeat_daily")],
-            [InlineKeyboardButton(text=REPEAT_TYPES["weekly"], callback_data="repeat_weekly")],
-            [InlineKeyboardButton(text=REPEAT_TYPES["monthly"], callback_data="repeat_monthly")]
-        ])
-        await message.answer("🔁 Выбери, как часто повторять:", reply_markup=kb)
-    except(ValueError, IndexError):
-        await message.answer("❌ Неверный формат. Введи чч:мм (например, 09:00)")
-   
-    except Exception as e:
-        print(f"🆘 Критическая ошибка: {e}")
-        await message.answer("❌ Ошибка. Админ уже чинит.")
+    # В хранилище — строкой, чтобы RedisStorage смог сериализовать
+    await state.update_data(remind_time=time.isoformat())
+    await state.set_state(Rem.waiting_repeat)
+
+    await message.answer("🔁 Выбери, как часто повторять:", reply_markup=REPEAT_KB)
 
 
 # === ВЫБОР ПОВТОРА ===
-@dp.callback_query(lambda c: c.data.startswith("repeat_"))
-async def set_repeat(callback: types.CallbackQuery):
+@dp.callback_query(F.data.startswith("repeat_"))
+async def set_repeat(callback: types.CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
     if not await check_subscription(user_id):
         await send_subscription_prompt(callback.message)
         await callback.answer()
         return
 
-    data = user_state.get(user_id)
-    if not data or data["step"] != "waiting_repeat":
+    if await state.get_state() != Rem.waiting_repeat.state:
         await callback.answer("❌ Сессия устарела.")
         return
 
+    data = await state.get_data()
+    remind_time = datetime.fromisoformat(data["remind_time"])
     repeat = callback.data.replace("repeat_", "")
     await save_reminder(
         user_id=user_id,
         message=data["message"],
-        remind_time=data["remind_time"],
+        remind_time=remind_time,
         repeat=repeat
     )
-    time_str = data["remind_time"].strftime("%d.%m %H:%M")
+    time_str = format_time(remind_time)
     await callback.message.edit_text(
         f"✅ Напоминание добавлено!\n"
         f"💬 {data['message']}\n"
         f"⏰ {time_str} (МСК)\n"
         f"🔄 {REPEAT_TYPES.get(repeat, 'Без повтора')}"
     )
-    user_state.pop(user_id, None)
+    await state.clear()
     print(f"✅ Напоминание добавлено: {data['message']} — {time_str}")
     await callback.answer()
 
 # === ПОКАЗАТЬ НАПОМИНАНИЯ ===
-@dp.message(lambda m: m.text == "📋 Мои напоминания")
+REMINDERS_PAGE_SIZE = 10
+# 10 пунктов по 100 символов точно влезают в лимит сообщения (4096)
+REMINDER_PREVIEW_LEN = 100
+
+def preview(text):
+    if len(text) <= REMINDER_PREVIEW_LEN:
+        return text
+    return text[:REMINDER_PREVIEW_LEN - 1] + "…"
+
+def render_reminders(rows, page):
+    # Одно сообщение на страницу: список + кнопка удаления на каждый пункт
+    pages = (len(rows) + REMINDERS_PAGE_SIZE - 1) // REMINDERS_PAGE_SIZE
+    page = max(0, min(page, pages - 1))
+    start = page * REMINDERS_PAGE_SIZE
+
+    lines = []
+    buttons = []
+    for i, row in enumerate(rows[start:start + REMINDERS_PAGE_SIZE], start=start + 1):
+        lines.append(
+            f"{i}. 🔔 {preview(row['message'])}\n"
+            f"    ⏰ {format_time(row['remind_time'])} (МСК) · "
+            f"{REPEAT_TYPES.get(row['repeat'], 'Без повтора')}"
+        )
+        buttons.append([InlineKeyboardButton(text=f"❌ {i}", callback_data=f"delete_{row['id']}_{page}")])
+
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton(text="⬅️", callback_data=f"page_{page - 1}"))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton(text="➡️", callback_data=f"page_{page + 1}"))
+    if nav:
+        buttons.append(nav)
+        lines.append(f"\n📄 Страница {page + 1}/{pages}")
+
+    return "\n".join(lines), InlineKeyboardMarkup(inline_keyboard=buttons)
+
+@dp.message(F.text == "📋 Мои напоминания")
 async def show_reminders(message: types.Message):
     user_id = message.from_user.id
     if not await check_subscription(user_id):
@@ -266,19 +468,33 @@ async def show_reminders(message: types.Message):
         await message.answer("📌 У тебя нет активных напоминаний.")
         return
 
-    for row in rows:
-        time_str = row["remind_time"].astimezone(MOSCOW_TZ).strftime("%d.%m %H:%M")
-        kb = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="❌ Удалить", callback_data=f"delete_{row['id']}")]
-        ])
-        await message.answer(
-            f"🔔 {row['message']}\n⏰ {time_str} (МСК)\n"
-            f"🔄 {REPEAT_TYPES.get(row['repeat'], 'Без повтора')}",
-            reply_markup=kb
-        )
+    text, kb = render_reminders(rows, 0)
+    await message.answer(text, reply_markup=kb)
+
+# === ЛИСТАНИЕ СПИСКА ===
+@dp.callback_query(F.data.startswith("page_"))
+async def turn_page(callback: types.CallbackQuery):
+    user_id = callback.from_user.id
+    if not await check_subscription(user_id):
+        await send_subscription_prompt(callback.message)
+        await callback.answer()
+        return
+
+    rows = await load_user_reminders(user_id)
+    try:
+        if not rows:
+            await callback.message.edit_text("📌 У тебя нет активных напоминаний.")
+        else:
+            text, kb = render_reminders(rows, int(callback.data.split("_")[1]))
+            await callback.message.edit_text(text, reply_markup=kb)
+    except TelegramBadRequest as e:
+        # Страница не изменилась (например, номер упёрся в границу)
+        if "message is not modified" not in str(e):
+            raise
+    await callback.answer()
 
 # === УДАЛЕНИЕ ЧЕРЕЗ КНОПКУ ===
-@dp.callback_query(lambda c: c.data.startswith("delete_"))
+@dp.callback_query(F.data.startswith("delete_"))
 async def delete_rem(callback: types.CallbackQuery):
     user_id = callback.from_user.id
     if not await check_subscription(user_id):
@@ -287,64 +503,199 @@ async def delete_rem(callback: types.CallbackQuery):
         return
 
     try:
-        rem_id = int(callback.data.split("_")[1])
+        parts = callback.data.split("_")
+        rem_id = int(parts[1])
+        page = int(parts[2]) if len(parts) > 2 else 0
         await delete_reminder_by_id(rem_id)
         await callback.answer("✅ Напоминание удалено")
-        await callback.message.edit_text("❌ Это напоминание удалено.")
         print(f"🗑️ Напоминание {rem_id} удалено")
+
+        # Перерисовываем список на той же странице
+        rows = await load_user_reminders(user_id)
+        if not rows:
+            await callback.message.edit_text("📌 У тебя нет активных напоминаний.")
+        else:
+            text, kb = render_reminders(rows, page)
+            await callback.message.edit_text(text, reply_markup=kb)
     except Exception as e:
         await callback.answer("❌ Уже удалено")
         print(f"❌ Ошибка удаления: {e}")
 
+# === ОБЩИЙ ОБРАБОТЧИК ОШИБОК ===
+@dp.errors()
+async def on_error(event: types.ErrorEvent):
+    e = event.exception
+    print(f"🆘 Критическая ошибка: {e}")
+    traceback.print_exception(type(e), e, e.__traceback__)
+    try:
+        if event.update.message:
+            await event.update.message.answer("❌ Ошибка. Админ уже чинит.")
+        elif event.update.callback_query:
+            await event.update.callback_query.answer("❌ Ошибка. Админ уже чинит.", show_alert=True)
+    except Exception as reply_error:
+        print(f"❌ Не удалось сообщить об ошибке: {reply_error}")
+    return True
+
 # === ФОН: ПРОВЕРКА И ПОВТОРЫ ===
+CLAIM_BATCH = 500    # напоминаний за один проход
+SEND_TIMEOUT = 15    # сек на запрос к Telegram
+LISTEN_MAX_WAIT = 60 # сек; страховка, если NOTIFY не дошёл
+
+def is_permanent_send_error(e):
+    # Бот заблокирован или Telegram отверг сам запрос (чата нет и т.п.) —
+    # повтор даст ту же ошибку
+    return isinstance(e, (TelegramForbiddenError, TelegramBadRequest))
+
+# Забираем созревшие напоминания в аренду на 5 минут одним UPDATE.
+# SKIP LOCKED — два процесса не возьмут одно и то же; транзакция
+# коммитится сразу, блокировки не висят, пока идут запросы к Telegram.
+# Если процесс упадёт посреди отправки, аренда истечёт и будет повтор.
+CLAIM_SQL = f"""
+    UPDATE reminders SET claimed_until = now() + interval '5 minutes'
+    WHERE id IN (
+        SELECT id FROM reminders
+        WHERE remind_time <= now()
+          AND (claimed_until IS NULL OR claimed_until <= now())
+        ORDER BY remind_time
+        LIMIT {CLAIM_BATCH}
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, user_id, message, repeat
+"""
+
 async def check_reminders():
-    print("⏱️ Фоновая проверка напоминаний запущена (каждые 10 сек)")
+    wakeup = asyncio.Event()
+    listen_conn = None
+    listen_lost = False
+
+    def on_listen_lost(conn):
+        nonlocal listen_lost
+        listen_lost = True
+        wakeup.set()
+
+    async def start_listening():
+        # Отдельное соединение держим, пока оно живо
+        conn = await db_pool.acquire()
+        try:
+            await conn.add_listener("reminders_new", lambda *_: wakeup.set())
+            conn.add_termination_listener(on_listen_lost)
+        except Exception:
+            await db_pool.release(conn)
+            raise
+        return conn
+
+    listening = USE_LISTEN
+    if listening:
+        try:
+            listen_conn = await start_listening()
+        except Exception as e:
+            listening = False
+            print(f"❌ LISTEN недоступен, перехожу на опрос: {e}")
+
+    if listening:
+        print("⏱️ Фоновая проверка напоминаний запущена (LISTEN reminders_new)")
+    else:
+        print("⏱️ Фоновая проверка напоминаний запущена (адаптивный опрос)")
+
     while True:
-        now = datetime.now(MOSCOW_TZ)
-        rows = await db_pool.fetch("SELECT * FROM reminders WHERE remind_time <= $1", now)
-        for row in rows:
+        wakeup.clear()
+
+        # Соединение с LISTEN оборвалось (рестарт БД, сеть) — подключаемся заново
+        if listening and (listen_lost or listen_conn is None):
+            if listen_conn is not None:
+                try:
+                    await db_pool.release(listen_conn)
+                except Exception:
+                    pass
+            listen_conn = None
+            listen_lost = False
             try:
-                await bot.send_message(row["user_id"], f"{row['message']}")
-                print(f"📨 Отправлено: {row['message']} (ID: {row['id']})")
+                listen_conn = await start_listening()
+                print("🔌 LISTEN reminders_new восстановлен")
             except Exception as e:
-                print(f"❌ Ошибка отправки: {e}")
-                continue
-
-            await delete_reminder_by_id(row["id"])
-            print(f"🗑️ Удалено из БД: {row['id']}")
-
-            # Повтор
-            new_time = None
-            if row["repeat"] == "daily":
-                new_time = now + timedelta(days=1)
-            elif row["repeat"] == "weekly":
-                new_time = now + timedelta(weeks=1)
-            elif row["repeat"] == "monthly":
-                new_time = now + timedelta(days=30)
-
-            if new_time:
-                await save_reminder(
-                    row["user_id"],
-                    row["message"],
-                    new_time,
-                    row["repeat"]
+                print(f"❌ Не удалось восстановить LISTEN: {e}")
+
+        try:
+            # Record распаковываем по позиции — порядок как в RETURNING
+            rows = await db_pool.fetch(CLAIM_SQL)
+            sends = [
+                send_limited(user_id, text, request_timeout=SEND_TIMEOUT)
+                for _, user_id, text, _ in rows
+            ]
+            results = await asyncio.gather(*sends, return_exceptions=True)
+
+            one_shot_ids = []
+            recurring_ids = []
+            retry_ids = []
+            for (rem_id, _, text, repeat), result in zip(rows, results):
+                if isinstance(result, Exception):
+                    print(f"❌ Ошибка отправки: {result}")
+                    if not is_permanent_send_error(result):
+                        retry_ids.append(rem_id)
+                        continue
+                    # Этот раз пропускаем: разовое удалится, повтор перенесётся
+                    # на следующий срок — вдруг пользователь разблокирует бота
+                    print(f"🚫 Не доставлено, пропускаю (ID: {rem_id})")
+                else:
+                    print(f"📨 Отправлено: {text} (ID: {rem_id})")
+
+                if repeat in REPEAT_INTERVALS:
+                    recurring_ids.append(rem_id)
+                else:
+                    one_shot_ids.append(rem_id)
+
+            if one_shot_ids:
+                await db_pool.execute("DELETE FROM reminders WHERE id = ANY($1::int[])", one_shot_ids)
+                print(f"🗑️ Удалено из БД: {one_shot_ids}")
+            # Повтор считаем от remind_time, а не от now — без дрейфа
+            if recurring_ids:
+                await db_pool.execute(RESCHEDULE_SQL, recurring_ids)
+                print(f"🔁 Повтор перенесён: {recurring_ids}")
+            # Временная ошибка — продлеваем аренду на минуту вместо долбёжки
+            if retry_ids:
+                await db_pool.execute(
+                    "UPDATE reminders SET claimed_until = now() + interval '1 minute' WHERE id = ANY($1::int[])",
+                    retry_ids
                 )
-                print(f"🔁 Повтор создан: {row['message']} — {new_time.strftime('%d.%m %H:%M')}")
 
-        await asyncio.sleep(10)
-
-# === ОБРАБОТЧИК ВЕБХУКА ===
-async def handle_webhook(request):
-    try:
-        update_json = await request.json()
-        update = types.Update(**update_json)
-        await dp.feed_update(bot, update)
-        return web.Response(status=200)
-    except Exception as e:
-        print(f"❌ Ошибка в вебхуке: {e}")
-        import traceback
-        traceback.print_exc()
-        return web.Response(status=500)
+        except Exception as e:
+            # БД недоступна (рестарт, сеть) — не роняем фоновую задачу
+            print(f"❌ Ошибка фоновой проверки: {e}")
+            traceback.print_exc()
+            await asyncio.sleep(5)
+            continue
+
+        # Забрали полную пачку — наверняка есть ещё, идём сразу
+        if len(rows) == CLAIM_BATCH:
+            continue
+
+        # Секунд до ближайшего напоминания — считаем на стороне БД.
+        # Арендованные учитываем по окончанию аренды (GREATEST пропускает NULL)
+        try:
+            delay = await db_pool.fetchval(
+                "SELECT EXTRACT(EPOCH FROM (min(GREATEST(remind_time, claimed_until)) - now())) FROM reminders"
+            )
+        except Exception as e:
+            print(f"❌ Ошибка фоновой проверки: {e}")
+            delay = None
+
+        if not listening:
+            # Опрос: чаще перед ближайшим напоминанием, реже при пустой таблице
+            if delay is None:
+                await asyncio.sleep(60)
+            else:
+                await asyncio.sleep(max(0.5, min(10.0, float(delay))))
+            continue
+
+        # Спим до ближайшего напоминания или до NOTIFY о новом, но не
+        # дольше минуты — на случай потерянного NOTIFY или сбоя триггера
+        timeout = LISTEN_MAX_WAIT
+        if delay is not None:
+            timeout = max(0.1, min(LISTEN_MAX_WAIT, float(delay)))
+        try:
+            await asyncio.wait_for(wakeup.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
 
 # === ЗАПУСК НА RENDER С ВЕБХУКОМ ===
 async def main():
@@ -352,11 +703,17 @@ async def main():
 
     # Инициализация
     await init_db()
-    asyncio.create_task(check_reminders())
+    # Держим ссылку: цикл событий хранит задачи только по слабой ссылке
+    reminders_task = asyncio.create_task(check_reminders())
 
     # Веб-приложение
     app = web.Application()
-    app.router.add_post(f"/{TOKEN}", handle_webhook)
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
     app.router.add_get("/", lambda _: web.Response(text="OK", status=200))
     app.router.add_get("/health", lambda _: web.Response(text="OK", status=200))
 
@@ -370,8 +727,12 @@ async def main():
     print(f"🌐 Веб-сервер запущен на порту {port}")
 
     # Установка вебхука
-    webhook_url = f"https://telegram-bot-ptrv.onrender.com/{TOKEN}"
-    await bot.set_webhook(webhook_url, allowed_updates=dp.resolve_used_update_types())
+    webhook_url = f"{BASE_URL}{WEBHOOK_PATH}"
+    await bot.set_webhook(
+        webhook_url,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types()
+    )
     print(f"🔧 Вебхук установлен: {webhook_url}")
 
     # Держим процесс живым